@@ -4,6 +4,10 @@
 
 
 
+import os
+import sys
+import types
+
 import tests
 
 try:
@@ -82,6 +86,123 @@ class TestGtkspellchecker(TestSpell, tests.TestCase):
 		TestSpell.runTest(self, zim.plugins.spell.GtkspellcheckAdapter)
 
 
+class TestBackendResolution(tests.TestCase):
+
+	# Cover the ZIM_SPELL_BACKEND handling in _resolve_backend() without
+	# requiring a real backend by putting a stub module in sys.modules
+
+	def setUp(self):
+		self._restore = (
+			zim.plugins.spell.gtkspell,
+			zim.plugins.spell.gtkspellcheck,
+			zim.plugins.spell._backend_resolved,
+			zim.plugins.spell._gtkspellcheck_patched,
+		)
+		zim.plugins.spell.gtkspell = None
+		zim.plugins.spell.gtkspellcheck = None
+		zim.plugins.spell._backend_resolved = False
+
+		self._stub = types.ModuleType('gtkspellcheck')
+		self._stub.SpellChecker = type('SpellChecker', (), {})
+		self._stub.__version__ = '5.0.0'
+		self._orig_module = sys.modules.get('gtkspellcheck')
+		sys.modules['gtkspellcheck'] = self._stub
+		self._orig_env = os.environ.get('ZIM_SPELL_BACKEND')
+
+	def tearDown(self):
+		zim.plugins.spell.gtkspell, zim.plugins.spell.gtkspellcheck, \
+			zim.plugins.spell._backend_resolved, \
+				zim.plugins.spell._gtkspellcheck_patched = self._restore
+
+		if self._orig_module is None:
+			del sys.modules['gtkspellcheck']
+		else:
+			sys.modules['gtkspellcheck'] = self._orig_module
+
+		if self._orig_env is None:
+			os.environ.pop('ZIM_SPELL_BACKEND', None)
+		else:
+			os.environ['ZIM_SPELL_BACKEND'] = self._orig_env
+
+	def testDefaultPrefersGtkspellcheck(self):
+		zim.plugins.spell._resolve_backend()
+		self.assertIs(zim.plugins.spell.gtkspellcheck, self._stub)
+
+	def testOverrideSkipsGtkspellcheck(self):
+		os.environ['ZIM_SPELL_BACKEND'] = 'gtkspell'
+		zim.plugins.spell._resolve_backend()
+		self.assertIsNone(zim.plugins.spell.gtkspellcheck)
+
+	def testUnknownBackendIgnored(self):
+		os.environ['ZIM_SPELL_BACKEND'] = 'aspell'
+		with tests.LoggingFilter(logger='zim.plugins.spell', message='Ignoring unknown ZIM_SPELL_BACKEND'):
+			zim.plugins.spell._resolve_backend()
+		self.assertIs(zim.plugins.spell.gtkspellcheck, self._stub)
+
+	def testExternallySetBackendNotOverwritten(self):
+		zim.plugins.spell.gtkspell = self._stub # stands in for a backend set externally
+		zim.plugins.spell._resolve_backend()
+		self.assertIsNone(zim.plugins.spell.gtkspellcheck)
+		self.assertIs(zim.plugins.spell.gtkspell, self._stub)
+
+
+class TestParseVersion(tests.TestCase):
+
+	def runTest(self):
+		self.assertEqual(zim.plugins.spell._parse_version('4.0.5'), (4, 0, 5))
+		self.assertEqual(zim.plugins.spell._parse_version('5.1'), (5, 1))
+		self.assertTrue(zim.plugins.spell._parse_version('4.0.5') >= (4, 0, 3))
+
+
+class TestSafeCodeToName(tests.TestCase):
+
+	def setUp(self):
+		self._restore = zim.plugins.spell._code_to_name
+		self._cache = dict(zim.plugins.spell._CODE_NAME_CACHE)
+		zim.plugins.spell._CODE_NAME_CACHE.clear()
+
+	def tearDown(self):
+		zim.plugins.spell._code_to_name = self._restore
+		zim.plugins.spell._CODE_NAME_CACHE.clear()
+		zim.plugins.spell._CODE_NAME_CACHE.update(self._cache)
+
+	def runTest(self):
+		calls = []
+
+		def code_to_name(code):
+			calls.append(code)
+			if code == 'xx':
+				raise KeyError(code)
+			return 'Name ' + code
+
+		zim.plugins.spell._code_to_name = code_to_name
+
+		with tests.LoggingFilter(logger='zim.plugins.spell'): # Hide exceptions
+			self.assertEqual(zim.plugins.spell._safe_code_to_name('nl'), 'Name nl')
+			self.assertEqual(zim.plugins.spell._safe_code_to_name('xx'), 'xx')
+			self.assertEqual(zim.plugins.spell._safe_code_to_name('nl'), 'Name nl')
+			self.assertEqual(zim.plugins.spell._safe_code_to_name('xx'), 'xx')
+
+		self.assertEqual(calls, ['nl', 'xx']) # results - also failures - are cached
+
+
+class TestCheckDependencies(tests.TestCase):
+
+	def setUp(self):
+		self._restore = zim.plugins.spell.SpellPlugin._dependencies_cache
+		zim.plugins.spell.SpellPlugin._dependencies_cache = None
+
+	def tearDown(self):
+		zim.plugins.spell.SpellPlugin._dependencies_cache = self._restore
+
+	def runTest(self):
+		first = zim.plugins.spell.SpellPlugin.check_dependencies()
+		check, dependencies = first
+		self.assertIsInstance(check, bool)
+		self.assertEqual([d[0] for d in dependencies], ['gtkspellcheck', 'gtkspell'])
+		self.assertIs(zim.plugins.spell.SpellPlugin.check_dependencies(), first) # cached
+
+
 class TestReplaceWordWithFormatting(TextBufferTestCaseMixin, tests.TestCase):
 
 	# Since spell checker is hard to trigger from test, copied relevant code from:
@@ -3,13 +3,20 @@
 
 '''Spell check plugin based on gtkspell'''
 
+import os
 import re
 import locale
 import logging
+import functools
+import importlib.util
+
+from operator import itemgetter
 
 logger = logging.getLogger('zim.plugins.spell')
 
 
+from gi.repository import GLib
+
 from zim.plugins import PluginClass
 from zim.signals import SIGNAL_AFTER
 from zim.actions import toggle_action
@@ -18,48 +25,155 @@ from zim.gui.pageview import PageViewExtension
 from zim.gui.widgets import ErrorDialog
 
 
-# Try which of the two bindings is available
-try:
-	import gtkspellcheck
-except ImportError:
-	gtkspellcheck = None
+# The spell checking bindings are imported lazily by _resolve_backend()
+# because importing them pulls in enchant and extra typelibs, which slows
+# down startup even when the plugin is never used
+gtkspellcheck = None
+gtkspell = None
+
+_backend_resolved = False
+_gtkspellcheck_patched = False
+
+# Tag names that gtkspellcheck versions install in the buffer tag table
+_SPELL_TAG_NAMES = frozenset((
+	'gtkspellchecker-misspelled',
+	'gtkspellchecker-ignored',
+))
+
+_VERSION_RE = re.compile(r'\d+')
 
+_UNSET = object()
+_DEFAULT_LANG = _UNSET
+
+_code_to_name = None
+_CODE_NAME_CACHE = {}
+_language_list_cache = None
+
+
+def _safe_code_to_name(code):
+	# Map a language code to a display name, caching results; failures
+	# are cached as the code itself, so each code pays the exception
+	# machinery at most once
 	try:
-		import gi
-		gi.require_version('GtkSpell', '3.0')
-		from gi.repository import GtkSpell as gtkspell
-	except:
-		gtkspell = None
-else:
-	gtkspell = None
+		return _CODE_NAME_CACHE[code]
+	except KeyError:
+		global _code_to_name
+		if _code_to_name is None:
+			# Deferred import - only pay for loading the locales
+			# database when the fallback actually triggers
+			from pylocales import code_to_name as _code_to_name
 
+		try:
+			name = _code_to_name(code)
+		except:
+			logger.exception('While loading language for: %s', code)
+			name = code
+		_CODE_NAME_CACHE[code] = name
+		return name
 
-# Hotfix for robustness of loading languages in gtkspellcheck
-# try to be robust for future versions breaking this or not needing it
-# See https://github.com/koehlma/pygtkspellcheck/issues/22
-if gtkspellcheck \
-and hasattr(gtkspellcheck.SpellChecker, '_LanguageList') \
-and hasattr(gtkspellcheck.SpellChecker._LanguageList, 'from_broker'):
-	from pylocales import code_to_name
 
-	orig_from_broker = gtkspellcheck.SpellChecker._LanguageList.from_broker
+def _default_lang():
+	# locale.getdefaultlocale() parses environment variables and is
+	# invariant during the session, so compute it only once; the result
+	# can be None, which tells the backends to pick a language themselves
+	global _DEFAULT_LANG
+	if _DEFAULT_LANG is _UNSET:
+		_DEFAULT_LANG = locale.getdefaultlocale()[0]
+	return _DEFAULT_LANG
 
-	@classmethod
-	def new_from_broker(cls, broker):
+
+def _resolve_backend():
+	# Try which of the two bindings is available; imports are deferred
+	# until the plugin is actually used, module globals are set here so
+	# the rest of the module (and the test suite) can inspect them
+	global gtkspellcheck, gtkspell, _backend_resolved
+
+	if _backend_resolved or gtkspellcheck or gtkspell:
+		return # resolved before, or modules set externally by tests
+
+	_backend_resolved = True
+
+	# Allow the user to shortcut the probing order, e.g. to avoid
+	# importing gtkspellcheck at all when gtkspell is preferred
+	backend = os.environ.get('ZIM_SPELL_BACKEND', '').strip().lower()
+	if backend and backend not in ('gtkspellcheck', 'gtkspell'):
+		logger.warning('Ignoring unknown ZIM_SPELL_BACKEND: %s', backend)
+		backend = ''
+
+	if backend != 'gtkspell':
+		try:
+			import gtkspellcheck as _gtkspellcheck
+		except ImportError:
+			pass
+		else:
+			gtkspellcheck = _gtkspellcheck
+			_patch_gtkspellcheck()
+			return
+
+	if backend != 'gtkspellcheck':
 		try:
-			return orig_from_broker(broker)
+			import gi
+			gi.require_version('GtkSpell', '3.0')
+			from gi.repository import GtkSpell as _gtkspell
 		except:
-			lang = []
-			for language in broker.list_languages():
+			pass
+		else:
+			gtkspell = _gtkspell
+
+
+@functools.lru_cache(maxsize=1)
+def _parse_version(version_string):
+	# The version never changes within a process, so parse it only once;
+	# keyed on the string so the test suite can still swap backends
+	return tuple(map(int, _VERSION_RE.findall(version_string)))
+
+
+def _find_gtkspell_typelib():
+	# Check whether the GtkSpell typelib is installed without loading it
+	try:
+		import gi
+		return bool(gi.Repository.get_default().enumerate_versions('GtkSpell'))
+	except Exception:
+		return False
+
+
+def _patch_gtkspellcheck():
+	# Hotfix for robustness of loading languages in gtkspellcheck
+	# try to be robust for future versions breaking this or not needing it
+	# See https://github.com/koehlma/pygtkspellcheck/issues/22
+	global _gtkspellcheck_patched
+
+	if _gtkspellcheck_patched:
+		return
+	_gtkspellcheck_patched = True
+
+	if gtkspellcheck \
+	and hasattr(gtkspellcheck.SpellChecker, '_LanguageList') \
+	and hasattr(gtkspellcheck.SpellChecker._LanguageList, 'from_broker') \
+	and importlib.util.find_spec('pylocales') is not None:
+		orig_from_broker = gtkspellcheck.SpellChecker._LanguageList.from_broker
+
+		@classmethod
+		def new_from_broker(cls, broker):
+			# The available languages are a property of the enchant
+			# installation and do not change within a process; compute the
+			# list once and share it between all checkers instead of
+			# walking the broker again for every SpellChecker constructed
+			global _language_list_cache
+
+			if _language_list_cache is None:
 				try:
-					lang.append((language, code_to_name(language)))
+					_language_list_cache = list(orig_from_broker(broker))
 				except:
-					logger.exception('While loading language for: %s', language)
+					lang = [
+						(code, _safe_code_to_name(code))
+							for code in broker.list_languages()
+					]
+					_language_list_cache = sorted(lang, key=itemgetter(1))
 
-			return cls(sorted(lang, key=lambda language: language[1]))
+			return cls(_language_list_cache)
 
-	gtkspellcheck.SpellChecker._LanguageList.from_broker = new_from_broker
-#####
+		gtkspellcheck.SpellChecker._LanguageList.from_broker = new_from_broker
 
 
 
@@ -80,30 +194,55 @@ This is a core plugin shipping with zim.
 		('language', 'string', 'Default Language', ''),
 	)
 
+	_dependencies_cache = None
+
 	@classmethod
 	def check_dependencies(klass):
-		return bool(gtkspellcheck or gtkspell), [
-			('gtkspellcheck', not gtkspellcheck is None, True),
-			('gtkspell', not gtkspell is None, True)
+		# Called repeatedly by the plugin infrastructure while the
+		# answer does not change within the process, so cache it
+		if klass._dependencies_cache is not None:
+			return klass._dependencies_cache
+
+		if gtkspellcheck or gtkspell:
+			has_gtkspellcheck = gtkspellcheck is not None
+			has_gtkspell = gtkspell is not None
+		else:
+			# Probe without importing - the real import is deferred to
+			# _resolve_backend() when the plugin is used
+			has_gtkspellcheck = importlib.util.find_spec('gtkspellcheck') is not None
+			has_gtkspell = _find_gtkspell_typelib()
+
+		klass._dependencies_cache = bool(has_gtkspellcheck or has_gtkspell), [
+			('gtkspellcheck', has_gtkspellcheck, True),
+			('gtkspell', has_gtkspell, True)
 		]
+		return klass._dependencies_cache
 
 
 class SpellPageViewExtension(PageViewExtension):
 
 	def __init__(self, plugin, pageview):
 		PageViewExtension.__init__(self, plugin, pageview)
+		_resolve_backend()
 
 		properties = self.plugin.notebook_properties(self.pageview.notebook)
 		self._language = properties['language']
 		self.connectto(properties, 'changed', self.on_properties_changed)
 
 		self._adapter_cls = self._choose_adapter_cls()
+		self._pending_page_change = None
 		self.uistate.setdefault('active', False)
-		self.toggle_spellcheck(self.uistate['active'])
+		if self.uistate['active']:
+			self.toggle_spellcheck(True)
+		# else no need to disable() a checker that was never constructed
 		self.connectto(self.pageview, 'page-changed', order=SIGNAL_AFTER)
 
 	def on_properties_changed(self, properties):
+		old_lang = self._language or _default_lang()
 		self._language = properties['language']
+		if (self._language or _default_lang()) == old_lang:
+			return # unrelated property changed - skip dictionary reload
+
 		textview = self.pageview.textview
 		checker = getattr(textview, '_gtkspell', None)
 		if checker:
@@ -111,9 +250,7 @@ class SpellPageViewExtension(PageViewExtension):
 
 	def _choose_adapter_cls(self):
 		if gtkspellcheck:
-			version = tuple(
-				map(int, re.findall('\d+', gtkspellcheck.__version__))
-			)
+			version = _parse_version(gtkspellcheck.__version__)
 			if version >= (4, 0, 3):
 				return GtkspellcheckAdapter
 			else:
@@ -143,14 +280,23 @@ class SpellPageViewExtension(PageViewExtension):
 		self.uistate['active'] = active
 
 	def on_page_changed(self, pageview, page):
-		textview = pageview.textview
+		# Debounce, so when switching pages rapidly only the last page
+		# in the burst pays for re-initializing the checker
+		if self._pending_page_change:
+			GLib.source_remove(self._pending_page_change)
+		self._pending_page_change = GLib.timeout_add(
+			150, self._on_page_changed_timeout, pageview.textview)
+
+	def _on_page_changed_timeout(self, textview):
+		self._pending_page_change = None
 		checker = getattr(textview, '_gtkspell', None)
 		if checker:
 			checker.on_new_buffer()
+		return False # only run once
 
 	def setup(self):
 		textview = self.pageview.textview
-		lang = self._language or locale.getdefaultlocale()[0]
+		lang = self._language or _default_lang()
 		logger.debug('Spellcheck language: %s', lang)
 		try:
 			checker = self._adapter_cls(textview, lang)
@@ -165,6 +311,9 @@ class SpellPageViewExtension(PageViewExtension):
 			textview._gtkspell = checker
 
 	def teardown(self):
+		if self._pending_page_change:
+			GLib.source_remove(self._pending_page_change)
+			self._pending_page_change = None
 		textview = self.pageview.textview
 		if hasattr(textview, '_gtkspell') \
 		and textview._gtkspell is not None:
@@ -184,6 +333,9 @@ class GtkspellcheckAdapter(object):
 
 	def on_new_buffer(self):
 		if self._checker:
+			buffer = self._textview.get_buffer()
+			if getattr(self._checker, '_buffer', None) is buffer:
+				return # checker already attached to this buffer
 			self._checker.buffer_initialize()
 
 	def enable(self):
@@ -206,16 +358,21 @@ class GtkspellcheckAdapter(object):
 			self._checker = None
 		self._active = False
 
+	def _list_spell_tags(self, table):
+		# Look up the known gtkspellcheck tags directly instead of
+		# scanning the whole tag table with a callback per tag
+		tags = []
+		for name in _SPELL_TAG_NAMES:
+			tag = table.lookup(name)
+			if tag is not None:
+				tags.append(tag)
+		return tags
+
 	def _clean_tag_table(self):
 		## cleanup tag table - else next loading will fail
-		prefix = 'gtkspellchecker'
 		table = self._textview.get_buffer().get_tag_table()
-		tags = []
-		table.foreach(lambda tag: tags.append(tag))
-		for tag in tags:
-			name = tag.get_property('name')
-			if name and name.startswith(prefix):
-				table.remove(tag)
+		for tag in self._list_spell_tags(table):
+			table.remove(tag)
 
 
 class OldGtkspellcheckAdapter(GtkspellcheckAdapter):
@@ -237,6 +394,7 @@ class GtkspellAdapter(object):
 		self._lang = lang
 		self._textview = textview
 		self._checker = None
+		self._attached = False
 		self.enable()
 
 	def on_new_buffer(self):
@@ -244,14 +402,19 @@ class GtkspellAdapter(object):
 
 	def enable(self):
 		if not self._checker:
+			# Keep the checker object once constructed - set_language()
+			# loads the dictionary, which is the expensive part
 			self._checker = gtkspell.Checker()
 			self._checker.set_language(self._lang)
+		if not self._attached:
 			self._checker.attach(self._textview)
+			self._attached = True
 
 	def disable(self):
-		self.detach()
+		if self._checker and self._attached:
+			self._checker.detach()
+			self._attached = False
 
 	def detach(self):
-		if self._checker:
-			self._checker.detach()
-			self._checker = None
+		self.disable()
+		self._checker = None